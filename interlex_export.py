@@ -1,11 +1,12 @@
 #!/usr/bin/env python
-from io          import StringIO
 from collections import namedtuple
-from itertools   import chain
+from itertools   import repeat
 from argparse    import ArgumentParser
+import codecs
 import csv
-
-from construct import Struct, Array, OptionalGreedyRange, PascalString, ULInt8, ULInt16, ULInt32, SLInt32, Enum, Terminator
+import mmap
+import struct
+import sys
 
 InterlexEntry = namedtuple('InterlexEntry', [
     'word',
@@ -118,81 +119,175 @@ LANGUAGES = {
     8202:  LanguageInfo('Spanish',    'Venezuela',          'windows-1252'),
     1053:  LanguageInfo('Swedish',    None,                 'windows-1252'),
 }
-assert len(set(LANGUAGES.values())) == len(LANGUAGES.values())
-
-def build_interlex_format():
-    return Struct('interlex23',
-        PascalString('program_and_version', length_field = ULInt8('length')),
-        ULInt16('foreign_language_id'),
-        ULInt16('native_language_id'),
-        ULInt32('questions_attempted'),
-        ULInt32('questions_answered_correctly'),
-        PascalString('description', length_field = ULInt16('length')),
-        PascalString('author',      length_field = ULInt16('length')),
-        PascalString('comments',    length_field = ULInt16('length')),
-        # I have no idea what this is. It was always all zeros in my tests.
-        Array(10, ULInt8('unknown')),
-        ULInt32('word_count'),
-        Array(
-            lambda ctx: ctx.word_count,
-            Struct('entry',
-                PascalString('word',           length_field = ULInt16('length')),
-                PascalString('part_of_speech', length_field = ULInt16('length')),
-                PascalString('notes',          length_field = ULInt16('length')),
-                PascalString('translation',    length_field = ULInt16('length')),
-                # Every time a word gets tested, this field is set to the last value of the counter and the review_order counter
-                # is incremented. I think the purpose is to store the order in which the questions were last asked.
-                # Suprisingly, the value of the counter is remembered if you restart the program - it's not the highest
-                # of the values assigned to words.
-                # It's size is at least 2 bytes. It's most likely a 32-bit int.
-                SLInt32('review_order'),
-                # I have never seen value other than zero in this field. It being a 32-bit int is just my guess.
-                SLInt32('unknown'),
-                # -1 seems to indicate that the word has been learnt (displayed as greyed out in the UI)
-                SLInt32('penalty_points'),
-            ),
-        ),
-        Terminator,
+
+# Sanity check for the table above. It materializes a set of all the tuples, which is
+# pure import-time overhead, so it's off by default - enable it when editing the table.
+VALIDATE_LANGUAGES = False
+if VALIDATE_LANGUAGES:
+    assert len(set(LANGUAGES.values())) == len(LANGUAGES.values())
+
+# All integers in the format are little-endian. Strings are Pascal-style: a length prefix followed by that many bytes.
+U8_STRUCT         = struct.Struct('<B')
+U16_STRUCT        = struct.Struct('<H')
+U32_STRUCT        = struct.Struct('<I')
+HEADER_STRUCT     = struct.Struct('<HHII')
+ENTRY_TAIL_STRUCT = struct.Struct('<i4xi')
+
+def read_pascal_string(buffer, offset, length_struct):
+    (length,) = length_struct.unpack_from(buffer, offset)
+    offset   += length_struct.size
+
+    return (buffer[offset:offset + length], offset + length)
+
+def batch_decode(chunks, decode):
+    # Decoding the whole column as one NUL-joined blob amortizes the Python-level
+    # decoder call overhead over all entries. NUL can't appear inside Interlex
+    # strings, but if a file proves otherwise the join would throw the split off,
+    # so fall back to decoding string by string in that case.
+    if not chunks:
+        return []
+
+    blob = b'\x00'.join(chunks)
+    if blob.count(b'\x00') != len(chunks) - 1:
+        return [decode(chunk)[0] for chunk in chunks]
+
+    return decode(blob)[0].split('\x00')
+
+def read_entries(buffer, offset, count, foreign_decode, native_decode, interlex_order_base, file_description):
+    # This is the hot loop of the parser so it cuts a few corners: the columns are
+    # preallocated, the unpack functions are cached in locals and each entry comes out
+    # as a plain tuple with the fields of InterlexEntry, in the same order. Strings are
+    # collected as raw slices first and decoded in batches, one call per column.
+    raw_words        = [None] * count
+    raw_parts        = [None] * count
+    raw_notes        = [None] * count
+    raw_translations = [None] * count
+    review_orders    = [None] * count
+    penalty_points   = [None] * count
+    read_u16         = U16_STRUCT.unpack_from
+    read_tail        = ENTRY_TAIL_STRUCT.unpack_from
+    tail_size        = ENTRY_TAIL_STRUCT.size
+
+    for i in range(count):
+        start        = offset + 2
+        end          = start + read_u16(buffer, offset)[0]
+        raw_words[i] = buffer[start:end]
+
+        start        = end + 2
+        end          = start + read_u16(buffer, end)[0]
+        raw_parts[i] = buffer[start:end]
+
+        start        = end + 2
+        end          = start + read_u16(buffer, end)[0]
+        raw_notes[i] = buffer[start:end]
+
+        start               = end + 2
+        end                 = start + read_u16(buffer, end)[0]
+        raw_translations[i] = buffer[start:end]
+
+        # Every time a word gets tested, review_order is set to the last value of the counter and the counter
+        # is incremented. I think the purpose is to store the order in which the questions were last asked.
+        # Suprisingly, the value of the counter is remembered if you restart the program - it's not the highest
+        # of the values assigned to words.
+        # It's size is at least 2 bytes. It's most likely a 32-bit int.
+        # The 4 bytes in the middle are unknown - I have never seen a value other than zero in them. Them being
+        # a 32-bit int is just my guess. The '4x' in the format skips them without ever decoding an int object.
+        # In penalty_points -1 seems to indicate that the word has been learnt (displayed as greyed out in the UI).
+        review_orders[i], penalty_points[i] = read_tail(buffer, end)
+        offset                              = end + tail_size
+
+    words        = batch_decode(raw_words, foreign_decode)
+    parts        = batch_decode(raw_parts, native_decode)
+    notes        = batch_decode(raw_notes, native_decode)
+    translations = batch_decode(raw_translations, native_decode)
+
+    # The rows are produced lazily. writerows() consumes them one at a time, so the
+    # row tuples never exist all at once - only the column lists above do. zip()
+    # assembles each tuple in C, with range() supplying interlex_order and repeat()
+    # the shared description.
+    entries = zip(
+        words,
+        parts,
+        notes,
+        translations,
+        review_orders,
+        penalty_points,
+        range(interlex_order_base, interlex_order_base + count),
+        repeat(file_description, count),
     )
 
-def parse(input_file_path, file_format):
+    return (entries, offset)
+
+def parse_and_decode(input_file_path, interlex_order_base):
     with open(input_file_path, 'rb') as input_file:
-        return file_format.parse(input_file.read())
+        # Memory-map the file instead of reading it whole - pages get pulled in on demand
+        # straight from the page cache. The memoryview lets read_pascal_string() hand out
+        # zero-copy slices of the mapping instead of materializing a new bytes object for
+        # every string; the slices also keep the mapping alive until the last one is gone.
+        buffer = memoryview(mmap.mmap(input_file.fileno(), 0, access = mmap.ACCESS_READ))
+
+    program_and_version, offset = read_pascal_string(buffer, 0, U8_STRUCT)
+
+    (
+        foreign_language_id,
+        native_language_id,
+        questions_attempted,
+        questions_answered_correctly,
+    )       = HEADER_STRUCT.unpack_from(buffer, offset)
+    offset += HEADER_STRUCT.size
+
+    description, offset = read_pascal_string(buffer, offset, U16_STRUCT)
+    author,      offset = read_pascal_string(buffer, offset, U16_STRUCT)
+    comments,    offset = read_pascal_string(buffer, offset, U16_STRUCT)
+
+    # I have no idea what these 10 bytes are. They were always all zeros in my tests.
+    offset += 10
+
+    (word_count,) = U32_STRUCT.unpack_from(buffer, offset)
+    offset       += U32_STRUCT.size
+
+    foreign_language = LANGUAGES[foreign_language_id]
+    native_language  = LANGUAGES[native_language_id]
 
-def prepare_data_for_export(input_file_path, parsed_file, interlex_order_base):
     metadata = InterlexMetadata(
         input_file_path              = input_file_path,
-        program_and_version          = parsed_file.program_and_version.decode(METADATA_ENCODING),
-        description                  = parsed_file.description.decode(METADATA_ENCODING),
-        author                       = parsed_file.author.decode(METADATA_ENCODING),
-        comments                     = parsed_file.comments.decode(METADATA_ENCODING),
-        foreign_language_id          = parsed_file.foreign_language_id,
-        foreign_language_name        = LANGUAGES[parsed_file.foreign_language_id].name,
-        foreign_language_variety     = LANGUAGES[parsed_file.foreign_language_id].variety,
-        native_language_id           = parsed_file.native_language_id,
-        native_language_name         = LANGUAGES[parsed_file.native_language_id].name,
-        native_language_variety      = LANGUAGES[parsed_file.native_language_id].variety,
-        word_count                   = parsed_file.word_count,
-        questions_attempted          = parsed_file.questions_attempted,
-        questions_answered_correctly = parsed_file.questions_answered_correctly,
+        program_and_version          = str(program_and_version, METADATA_ENCODING),
+        description                  = str(description, METADATA_ENCODING),
+        author                       = str(author, METADATA_ENCODING),
+        comments                     = str(comments, METADATA_ENCODING),
+        foreign_language_id          = foreign_language_id,
+        foreign_language_name        = foreign_language.name,
+        foreign_language_variety     = foreign_language.variety,
+        native_language_id           = native_language_id,
+        native_language_name         = native_language.name,
+        native_language_variety      = native_language.variety,
+        word_count                   = word_count,
+        questions_attempted          = questions_attempted,
+        questions_answered_correctly = questions_answered_correctly,
     )
 
-    foreign_encoding = LANGUAGES[parsed_file.foreign_language_id].codepage
-    native_encoding  = LANGUAGES[parsed_file.native_language_id].codepage
-
-    entries = [
-        InterlexEntry(
-            word             = entry.word.decode(foreign_encoding),
-            part_of_speech   = entry.part_of_speech.decode(native_encoding),
-            notes            = entry.notes.decode(native_encoding),
-            translation      = entry.translation.decode(native_encoding),
-            review_order     = entry.review_order,
-            penalty_points   = entry.penalty_points,
-            interlex_order   = interlex_order_base + i,
-            file_description = metadata.description,
-        )
-        for (i, entry) in enumerate(parsed_file.entry)
-    ]
+    # Resolving the codecs by name once and calling the decoders directly avoids
+    # a codec registry lookup for every string in the entry loop.
+    foreign_decode = codecs.getdecoder(foreign_language.codepage)
+    native_decode  = codecs.getdecoder(native_language.codepage)
+
+    # Every entry carries the same description. Interning it guarantees that all
+    # of them share a single string object, even across files with identical
+    # descriptions, and makes any later comparisons on the column O(1).
+    file_description = sys.intern(metadata.description)
+
+    entries, offset = read_entries(
+        buffer,
+        offset,
+        word_count,
+        foreign_decode,
+        native_decode,
+        interlex_order_base,
+        file_description,
+    )
+
+    # The entry array should extend exactly to the end of the file.
+    assert offset == len(buffer)
 
     return (metadata, entries)
 
@@ -203,33 +298,26 @@ def print_metadata(metadata):
 
         return '{} ({})'.format(language, variety)
 
-    print("File:                  {} ({})".format(metadata.input_file_path, metadata.program_and_version))
-    print("Description:           {}".format(metadata.description))
-    print("Author:                {}".format(metadata.author))
-    print("Foreign language:      {}".format(language_label(metadata.foreign_language_name, metadata.foreign_language_variety)))
-    print("Native language:       {}".format(language_label(metadata.native_language_name, metadata.native_language_variety)))
-    print("Words:                 {}".format(metadata.word_count))
-    print("Answers (correct/all): {}/{}".format(metadata.questions_answered_correctly, metadata.questions_attempted))
-    print("Comments:              {}".format(metadata.comments))
-
-def generate_csv(entries, include_header):
-    assert all(isinstance(entry, InterlexEntry) for entry in entries)
+    # One write instead of eight prints - f-string templates are compiled with the
+    # function, and the whole block reaches stdout in a single call.
+    sys.stdout.write(
+        f"File:                  {metadata.input_file_path} ({metadata.program_and_version})\n"
+        f"Description:           {metadata.description}\n"
+        f"Author:                {metadata.author}\n"
+        f"Foreign language:      {language_label(metadata.foreign_language_name, metadata.foreign_language_variety)}\n"
+        f"Native language:       {language_label(metadata.native_language_name, metadata.native_language_variety)}\n"
+        f"Words:                 {metadata.word_count}\n"
+        f"Answers (correct/all): {metadata.questions_answered_correctly}/{metadata.questions_attempted}\n"
+        f"Comments:              {metadata.comments}\n"
+    )
 
-    csv_output = StringIO()
-    writer     = csv.writer(csv_output, dialect = CSV_DIALECT, delimiter = CSV_DELIMITER)
+def create_csv_writer(output_file, include_header):
+    writer = csv.writer(output_file, dialect = CSV_DIALECT, delimiter = CSV_DELIMITER)
 
     if include_header:
-        header = InterlexEntry._fields
-        writer.writerow(header)
-
-    for entry in entries:
-        writer.writerow(entry)
-
-    return csv_output.getvalue()
+        writer.writerow(InterlexEntry._fields)
 
-def save_file(output_file_name, content):
-    with open(output_file_name, 'wb') as output_file:
-        output_file.write(content.encode('utf-8'))
+    return writer
 
 def parse_command_line():
     parser = ArgumentParser(description = "An utility for exporting data from Interlex binary format")
@@ -259,20 +347,17 @@ def parse_command_line():
 if __name__ == '__main__':
     command_line_options = parse_command_line()
 
-    file_format = build_interlex_format()
+    with open(command_line_options.output_file_path, 'w', encoding = 'utf-8', newline = '') as output_file:
+        writer = create_csv_writer(output_file, include_header = command_line_options.include_csv_header)
 
-    entry_sets          = []
-    interlex_order_base = 0
-    for input_file_path in command_line_options.input_file_paths:
-        parsed_file       = parse(input_file_path, file_format)
-        metadata, entries = prepare_data_for_export(input_file_path, parsed_file, interlex_order_base)
+        total_entry_count = 0
+        for input_file_path in command_line_options.input_file_paths:
+            metadata, entries = parse_and_decode(input_file_path, total_entry_count)
 
-        print_metadata(metadata)
-        print()
+            print_metadata(metadata)
+            print()
 
-        entry_sets.append(entries)
-        interlex_order_base += len(entries)
+            writer.writerows(entries)
+            total_entry_count += metadata.word_count
 
-    all_entries = list(chain(*entry_sets))
-    print("Saving all {} entries in {}".format(len(all_entries), command_line_options.output_file_path))
-    save_file(command_line_options.output_file_path, generate_csv(all_entries, include_header = command_line_options.include_csv_header))
+    print("Saved all {} entries in {}".format(total_entry_count, command_line_options.output_file_path))